@@ -1,47 +1,170 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
+import hashlib
+import io
+import os
 import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import polars as pl  # multithreaded groupby kernels for the monthly aggregation
+except ImportError:
+    pl = None
+
+try:
+    import python_calamine  # Rust-backed xlsx reader, much faster than openpyxl
+    EXCEL_ENGINE = "calamine"
+    # what a failed calamine read can raise: pandas < 2.2 rejects the engine name (ValueError),
+    # a workbook calamine cannot parse raises CalamineError (XmlError, ZipError, ...)
+    CALAMINE_ERRORS = (ValueError, ImportError, python_calamine.CalamineError)
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
+    CALAMINE_ERRORS = ()
+
+# Parquet copies of parsed workbooks, keyed on the file hash, so a re-uploaded file skips Excel parsing.
+# Bump PARQUET_CACHE_VERSION whenever the reader's output changes so older copies are not served.
+PARQUET_CACHE_DIR = Path(tempfile.gettempdir()) / "loan_dashboard_cache"
+PARQUET_CACHE_VERSION = 2
 
 st.set_page_config(page_title="Microfinance Loan Dashboard (Fixed)", layout="wide")
 st.title("📊 Microfinance Loan Analysis Dashboard")
 st.markdown("Upload your loan dataset (.xlsx). The app will try to automatically detect column names and avoid errors.")
 
+_NORM_RE = re.compile(r'[^a-z0-9]')
+
 def normalize(col_name: str) -> str:
     """Normalize column names: lowercase, remove non-alphanumeric characters."""
-    return re.sub(r'[^a-z0-9]', '', str(col_name).lower())
+    return _NORM_RE.sub('', str(col_name).lower())
 
-def find_column(df, candidates):
-    """Find first matching column in df whose normalized name matches any of the candidates (normalized)."""
-    norm_to_col = {normalize(c): c for c in df.columns}
-    for cand in candidates:
-        nc = normalize(cand)
+def find_column(df, candidates, norm_to_col=None):
+    """Find first matching column in df whose normalized name matches any of the candidates (normalized).
+
+    Pass `norm_to_col` ({normalized name: column}) to reuse one normalization of df.columns across lookups.
+    """
+    if norm_to_col is None:
+        norm_to_col = {normalize(c): c for c in df.columns}
+    norm_cands = [normalize(c) for c in candidates]
+    for nc in norm_cands:
         if nc in norm_to_col:
             return norm_to_col[nc]
     # if none matched exactly, try partial substring match
     for nc, col in norm_to_col.items():
-        for cand in candidates:
-            if normalize(cand) in nc or nc in normalize(cand):
-                return col
+        if any(cand in nc or nc in cand for cand in norm_cands):
+            return col
     return None
 
-# Upload file
-uploaded_file = st.file_uploader("Upload your Excel file (xlsx)", type=["xlsx"])
-if not uploaded_file:
-    st.info("Please upload an Excel file to begin analysis.")
-    st.stop()
-
-# Read file
-try:
-    df = pd.read_excel(uploaded_file, engine="openpyxl")
-except Exception as e:
-    st.error(f"Error reading Excel file: {e}")
-    st.stop()
-
-st.write("Detected columns:", list(df.columns))
+def parse_dates(series):
+    """Convert a column to datetime64, skipping conversion when the reader already produced datetimes."""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    # an explicit format keeps parsing in the vectorized C path instead of per-element dateutil
+    parsed = pd.to_datetime(series, format='ISO8601', errors='coerce')
+    if parsed.isna().all() and series.notna().any():
+        parsed = pd.to_datetime(series, errors='coerce')
+    return parsed
+
+def downcast_float(series):
+    """Return `series` as float32 if no value changes in the cast, otherwise unchanged."""
+    small = series.astype('float32')
+    if np.array_equal(small.to_numpy(dtype=float), series.to_numpy(dtype=float), equal_nan=True):
+        return small
+    return series
+
+def dedupe_headers(names):
+    """Make header names unique the way pandas does: repeats of 'x' become 'x.1', 'x.2', ..."""
+    counts = {}
+    out = []
+    for name in names:
+        count = counts.get(name, 0)
+        while count > 0:
+            counts[name] = count + 1
+            name = f"{name}.{count}"
+            count = counts.get(name, 0)
+        out.append(name)
+        counts[name] = count + 1
+    return out
+
+def read_openpyxl_rows(file_bytes):
+    """Read the active sheet with openpyxl in read-only mode, building the frame straight from row value tuples."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return pd.DataFrame()
+        # ragged rows (sheets without a <dimension> tag) are padded with None up to the widest one
+        df = pd.DataFrame(list(rows))
+    finally:
+        wb.close()
+    width = max(len(header), df.shape[1])
+    df = df.reindex(columns=range(width))
+    header = list(header) + [None] * (width - len(header))
+    df.columns = dedupe_headers([f"Unnamed: {i}" if name is None else name for i, name in enumerate(header)])
+    # read-only sheets can report formatted-but-empty rows past the data
+    return df.dropna(how='all')
+
+def read_workbook(file_bytes):
+    """Read the first sheet with calamine when available, otherwise (or if it fails) with read-only openpyxl."""
+    if EXCEL_ENGINE == "calamine":
+        try:
+            return pd.read_excel(io.BytesIO(file_bytes), engine="calamine")
+        except CALAMINE_ERRORS:
+            # pandas < 2.2 has no calamine engine; a workbook calamine rejects may still open in openpyxl
+            pass
+    return read_openpyxl_rows(file_bytes)
+
+def private_cache_dir():
+    """Create PARQUET_CACHE_DIR as 0700 and return it, or None if it is not a directory only we can access."""
+    try:
+        PARQUET_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        info = PARQUET_CACHE_DIR.lstat()
+    except OSError:
+        return None
+    # loan and customer data: refuse a directory (or symlink) another user created or can read
+    if not PARQUET_CACHE_DIR.is_dir() or PARQUET_CACHE_DIR.is_symlink():
+        return None
+    if hasattr(os, 'getuid'):
+        if info.st_uid != os.getuid():
+            return None
+        if info.st_mode & 0o077:
+            # e.g. a world-readable directory left by an older version of this app
+            try:
+                PARQUET_CACHE_DIR.chmod(0o700)
+            except OSError:
+                return None
+    return PARQUET_CACHE_DIR
+
+def load_loans(file_bytes: bytes) -> pd.DataFrame:
+    """Parse the uploaded workbook, reusing its Parquet copy when one exists (reruns hit prepare_loans' cache)."""
+    cache_dir = private_cache_dir()
+    if cache_dir is None:
+        return read_workbook(file_bytes)
+    digest = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+    path = cache_dir / f"loans_v{PARQUET_CACHE_VERSION}_{digest}.parquet"
+    try:
+        return pd.read_parquet(path)
+    except (ImportError, OSError, ValueError):
+        pass
+    df = read_workbook(file_bytes)
+    # best effort: pyarrow may be missing or a mixed-type column may not be storable as Parquet
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        df.to_parquet(tmp_path)
+        tmp_path.chmod(0o600)
+        os.replace(tmp_path, path)
+    except (ImportError, OSError, ValueError, TypeError):
+        tmp_path.unlink(missing_ok=True)
+    return df
 
 # Column detection (list common variants)
-col_candidates = {
+COL_CANDIDATES = {
     'loan_date': ['actual_date_of_loan', 'actual date of loan', 'disbursal_date', 'loan_date', 'date'],
     'sum_disbursed': ['sum_loan_amount_disbursed', 'sumloanamountdisbursed', 'sum_loan_amount', 'loan_amount', 'sumdisbursed'],
     'sum_setup_fee': ['sum_set_up_fee', 'sum_set_up_fees', 'sumsetupfee', 'setup_fee', 'sum set up fee'],
@@ -55,70 +178,285 @@ col_candidates = {
     'account_state': ['account_state_name', 'account_state']
 }
 
-found = {}
-for key, candidates in col_candidates.items():
-    col = find_column(df, candidates)
-    if col:
-        found[key] = col
+@st.cache_data(show_spinner=False)
+def prepare_loans(file_bytes: bytes):
+    """Detect, rename and type the canonical columns once per file. Returns (df, found mapping, raw column names)."""
+    df = load_loans(file_bytes)
+    raw_columns = list(df.columns)
+
+    found = {}
+    norm_to_col = {normalize(c): c for c in df.columns}
+    for key, candidates in COL_CANDIDATES.items():
+        col = find_column(df, candidates, norm_to_col)
+        if col:
+            found[key] = col
+
+    # Rename found columns to canonical short names for easier use below
+    rename_map = {}
+    for k, col in found.items():
+        rename_map[col] = k
+    df = df.rename(columns=rename_map)
+    if 'loan_date' not in df.columns:
+        return df, found, raw_columns
+    # Keep only the detected canonical columns; nothing below reads the rest of the sheet
+    df = df[list(rename_map.values())].copy()
+
+    # create Loan_Month_Year as a monthly Period: groups on int ordinals and sorts chronologically
+    df['loan_date'] = parse_dates(df['loan_date'])
+    df['Loan_Month_Year'] = df['loan_date'].dt.to_period('M')
+
+    # Numeric columns coerced once here (unparseable cells -> NaN), then float32 where every value fits exactly;
+    # halves the bytes each sum/groupby reads
+    for c in ('sum_disbursed', 'sum_recovered', 'sum_setup_fee', 'outstanding', 'days_past_due'):
+        if c in df.columns:
+            df[c] = downcast_float(pd.to_numeric(df[c], errors='coerce'))
+
+    # Low-cardinality text columns as categoricals so filters, groupbys and counts work on int codes
+    for c in ('loan_status', 'segment', 'gender', 'account_state', 'dpd_cat'):
+        if c in df.columns:
+            df[c] = df[c].astype('string').astype('category')
+    return df, found, raw_columns
+
+# Upload file
+uploaded_file = st.file_uploader("Upload your Excel file (xlsx)", type=["xlsx"])
+if not uploaded_file:
+    st.info("Please upload an Excel file to begin analysis.")
+    st.stop()
+
+# Read file and prepare the canonical columns (both cached per file)
+file_bytes = uploaded_file.getvalue()
+file_hash = hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+try:
+    df, found, raw_columns = prepare_loans(file_bytes)
+except Exception as e:
+    st.error(f"Error reading Excel file: {e}")
+    st.stop()
 
-# Rename found columns to canonical short names for easier use below
-rename_map = {}
-for k, col in found.items():
-    rename_map[col] = k
-df = df.rename(columns=rename_map)
+st.write("Detected columns:", raw_columns)
 
 # Check required date column
 if 'loan_date' not in df.columns:
     st.error("Could not detect a date column. Please ensure your file has a column like 'actual_date_of_loan'. Found columns: " + ", ".join(df.columns))
     st.stop()
 
-# create Loan_Month_Year
-df['loan_date'] = pd.to_datetime(df['loan_date'], errors='coerce')
-df['Loan_Month_Year'] = df['loan_date'].dt.to_period('M').astype(str)
-
 # Sidebar filters (only show if available)
 st.sidebar.header("Filters")
+# Filterable column -> sidebar label. Choices are the categorical's categories: O(K) per rerun, no column scan.
+FILTER_LABELS = {
+    'loan_status': "Loan Status",
+    'segment': "Segment",
+    'gender': "Gender",
+    'account_state': "Account State",
+}
 filters = {}
-if 'loan_status' in df.columns:
-    choices = sorted(df['loan_status'].dropna().astype(str).unique().tolist())
-    filters['loan_status'] = st.sidebar.multiselect("Loan Status", choices, default=choices)
-if 'segment' in df.columns:
-    choices = sorted(df['segment'].dropna().astype(str).unique().tolist())
-    filters['segment'] = st.sidebar.multiselect("Segment", choices, default=choices)
-if 'gender' in df.columns:
-    choices = sorted(df['gender'].dropna().astype(str).unique().tolist())
-    filters['gender'] = st.sidebar.multiselect("Gender", choices, default=choices)
-if 'account_state' in df.columns:
-    choices = sorted(df['account_state'].dropna().astype(str).unique().tolist())
-    filters['account_state'] = st.sidebar.multiselect("Account State", choices, default=choices)
-
-# Apply filters
-filtered = df.copy()
+for col, label in FILTER_LABELS.items():
+    if col in df.columns:
+        choices = df[col].cat.categories.tolist()
+        filters[col] = st.sidebar.multiselect(label, choices, default=choices)
+
+# Helper: rows of a categorical whose value is in `vals`, via a per-category lookup table indexed by the int codes
+def category_mask(series, vals):
+    categories = series.cat.categories
+    lookup = np.zeros(len(categories) + 1, dtype=bool)  # last slot: missing (code -1), never selected
+    idx = categories.get_indexer(vals)
+    lookup[idx[idx >= 0]] = True
+    return lookup[series.cat.codes.to_numpy()]
+
+# Apply filters: combine one boolean mask and slice the frame once
+mask = np.ones(len(df), dtype=bool)
 for k, vals in filters.items():
     if len(vals) > 0:
-        filtered = filtered[filtered[k].astype(str).isin(vals)]
+        mask &= category_mask(df[k], vals)
+filtered = df[mask]
 
 st.write(f"Filtered rows: {len(filtered)} (from {len(df)})")
 
-# Helper: chronological sort for monthly data
-def sort_month_df(month_df, month_col='Loan_Month_Year'):
-    tmp = month_df.copy()
-    tmp['_dt'] = pd.to_datetime(tmp[month_col].astype(str) + '-01', errors='coerce')
-    tmp = tmp.sort_values('_dt').drop(columns=['_dt'])
-    return tmp
-
-# --- Tabs ---
-tab_overview, tab_trend, tab_seg, tab_risk, tab_recovery, tab_dpdseg, tab_mom = st.tabs([
-    "Overview", "Trend Analysis", "Customer Segmentation", "Risk Analysis", "Repayment Rate (MoM)",
-    "DPD by Segment", "MoM % Change"
-])
+# Identifies the current (file, filter selection) pair for cached computations below
+state_key = (file_hash, tuple((k, tuple(vals)) for k, vals in filters.items()))
+# Every distinct filter selection adds an entry to the per-state caches below; bound them (LRU + expiry)
+# so a long-running server shared by many users does not grow without limit
+STATE_CACHE_MAX_ENTRIES = 64
+STATE_CACHE_TTL = 3600  # seconds
+
+# Helper: value counts of a categorical via np.bincount on its int codes; missing values are labelled 'Unknown'
+def count_values(series):
+    categories = series.cat.categories.tolist()
+    counts = np.bincount(series.cat.codes.to_numpy() + 1, minlength=len(categories) + 1)  # slot 0 = missing (-1)
+    counts = pd.Series(counts[1:].tolist() + [counts[0]], index=categories + ['Unknown'])
+    return counts[counts > 0].sort_values(ascending=False, kind='stable')
+
+# Helper: bin on the server so only bar heights, not every row, are sent to the browser
+def binned_histogram(values, nbins, title):
+    arr = values.to_numpy(dtype=float, na_value=np.nan)
+    counts, edges = np.histogram(arr[np.isfinite(arr)], bins=nbins)  # inf would break the auto-detected range
+    fig = go.Figure(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, width=np.diff(edges)))
+    fig.update_layout(title=title, xaxis_title=values.name, yaxis_title='count')
+    return fig
+
+# Helper: keep at most `cap` randomly chosen rows per group (original row order is preserved)
+def sample_per_group(frame, col, cap, seed=0):
+    if len(frame) <= cap:
+        return frame
+    order = np.random.default_rng(seed).permutation(len(frame))
+    rank = frame.iloc[order].groupby(col, observed=True, sort=False, dropna=False).cumcount().to_numpy()
+    return frame[rank[np.argsort(order)] < cap]
+
+# Helper: strip plot on WebGL (Scattergl) - one trace per colour group, jittered around integer x positions
+def webgl_strip(frame, x, y, color, title, jitter=0.3, seed=0):
+    groups = frame[x].cat.remove_unused_categories()
+    codes = groups.cat.codes.to_numpy()
+    labels = groups.cat.categories.tolist()
+    if (codes == -1).any():
+        codes = np.where(codes == -1, len(labels), codes)
+        labels.append('Unknown')
+    xs = codes + np.random.default_rng(seed).uniform(-jitter, jitter, len(frame))
+    ys = frame[y].to_numpy()
+    # hover shows each point's group label (as px.strip did), not its jittered numeric x
+    point_labels = np.array([str(label) for label in labels], dtype=object)[codes]
+    fig = go.Figure()
+    for name, idx in frame.groupby(color, sort=False, observed=True).indices.items():
+        fig.add_trace(go.Scattergl(x=xs[idx], y=ys[idx], mode='markers', name=str(name),
+                                   marker=dict(size=6, opacity=0.7), hovertext=point_labels[idx],
+                                   hovertemplate=f"{color}={name}<br>{x}=%{{hovertext}}<br>{y}=%{{y}}<extra></extra>"))
+    fig.update_layout(title=title, legend_title_text=color, yaxis_title=y,
+                      xaxis=dict(title=x, tickmode='array', tickvals=list(range(len(labels))), ticktext=labels))
+    return fig
+
+# Helper: month-over-month % change as float32; a zero previous month gives NaN rather than inf
+def mom_pct_change(values):
+    vals = np.asarray(values, dtype=np.float32)
+    prev = np.roll(vals, 1)
+    prev[:1] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(prev != 0, (vals - prev) / prev * 100.0, np.nan).astype(np.float32)
+
+# Helper: several series on one shared figure (one layout, one plot call) built from go.Scatter traces
+def multi_line(frame, x, ys, title, y_title=None, legend_title=None):
+    fig = go.Figure()
+    for y in ys:
+        fig.add_trace(go.Scatter(x=frame[x], y=frame[y], name=y, mode='lines+markers'))
+    fig.update_layout(title=title, xaxis_title=x, yaxis_title=y_title, legend_title_text=legend_title)
+    return fig
+
+# Helper: format the Period month column as 'YYYY-MM' labels, only at plotting time
+def with_month_labels(month_df, month_col='Loan_Month_Year'):
+    return month_df.assign(**{month_col: month_df[month_col].dt.strftime('%Y-%m')})
+
+# Helper: Polars version of the monthly groupby-sum; months travel as Period ordinals (int64)
+def monthly_sums_polars(narrow, cols):
+    valid = narrow['Loan_Month_Year'].notna().to_numpy()
+    data = {'_month': narrow['Loan_Month_Year'].array.asi8[valid]}
+    data.update((c, narrow[c].to_numpy()[valid]) for c in cols)
+    out = (pl.DataFrame(data, nan_to_null=True)
+           .group_by('_month').agg(pl.col(list(cols)).sum())
+           .sort('_month'))
+    monthly = out.drop('_month').to_pandas()
+    monthly.insert(0, 'Loan_Month_Year', pd.arrays.PeriodArray(out['_month'].to_numpy(), dtype='period[M]'))
+    return monthly
+
+# Metrics offered in the MoM % change view, in selectbox order
+MOM_METRICS = ('sum_setup_fee', 'sum_recovered', 'sum_disbursed')
+
+# Helper: Polars version of the per-segment DPD stats; segments travel as category codes (missing segment dropped)
+def segment_dpd_stats_polars(frame):
+    codes = frame['segment'].cat.codes.to_numpy()
+    dpd = frame['days_past_due'].to_numpy(dtype=float, na_value=np.nan)
+    valid = codes >= 0
+    dpd_col = pl.col('days_past_due')
+    out = (pl.DataFrame({'_segment': codes[valid], 'days_past_due': dpd[valid], '_overdue': (dpd > 0)[valid]}, nan_to_null=True)
+           .group_by('_segment')
+           .agg(dpd_col.count().alias('Count'), dpd_col.mean().alias('Mean_DPD'), dpd_col.median().alias('Median_DPD'),
+                dpd_col.max().alias('Max_DPD'), pl.col('_overdue').mean().alias('Pct_Overdue'))
+           .sort('_segment'))
+    seg_stats = out.drop('_segment').to_pandas()
+    seg_stats.insert(0, 'Segment', pd.Categorical.from_codes(out['_segment'].to_numpy(), dtype=frame['segment'].dtype))
+    return seg_stats
+
+@st.cache_data(show_spinner=False, max_entries=STATE_CACHE_MAX_ENTRIES, ttl=STATE_CACHE_TTL)
+def aggregate_monthly(state_key, _frame, _mask, cols):
+    """Monthly sums of `cols` over the masked rows (Period keys sort chronologically); `state_key` stands in for hashing the inputs."""
+    # float32 columns are lossless per cell, but PKR totals must accumulate in float64
+    narrow = _frame.loc[_mask, ['Loan_Month_Year', *cols]].astype(dict.fromkeys(cols, 'float64'))
+    if pl is not None and all(pd.api.types.is_numeric_dtype(narrow[c]) for c in cols):
+        monthly = monthly_sums_polars(narrow, cols)
+    else:
+        # sort stays on: it is the chronological order of the output (an int sort on the Period ordinals)
+        monthly = narrow.groupby('Loan_Month_Year')[list(cols)].sum().reset_index()
+    # derived series for the recovery-rate and MoM views, computed once alongside the sums
+    if {'sum_recovered', 'sum_disbursed'}.issubset(cols):
+        monthly['recovery_pct'] = (monthly['sum_recovered'] / monthly['sum_disbursed'] * 100).replace([float('inf'), -float('inf')], 0)
+    for c in MOM_METRICS:
+        if c in cols:
+            monthly[c + '_mom_pct'] = mom_pct_change(monthly[c])
+    return monthly
+
+@st.cache_data(show_spinner=False, max_entries=STATE_CACHE_MAX_ENTRIES, ttl=STATE_CACHE_TTL)
+def segment_dpd_stats(state_key, _frame):
+    """Per-segment DPD count/mean/median/max and % overdue for the filtered rows (`_frame`: segment, days_past_due)."""
+    if pl is not None:
+        seg_stats = segment_dpd_stats_polars(_frame)
+    else:
+        # one named aggregation over a single grouper; percent overdue is the mean of the boolean over every
+        # row of the segment (missing DPD counts as not overdue)
+        seg_stats = (_frame.assign(_overdue=_frame['days_past_due'] > 0)
+                     .groupby('segment', observed=True)
+                     .agg(Count=('days_past_due', 'count'), Mean_DPD=('days_past_due', 'mean'),
+                          Median_DPD=('days_past_due', 'median'), Max_DPD=('days_past_due', 'max'),
+                          Pct_Overdue=('_overdue', 'mean'))
+                     .rename_axis('Segment')
+                     .reset_index())
+    seg_stats['Pct_Overdue'] = (seg_stats['Pct_Overdue'] * 100).round(2)
+    return seg_stats
+
+@st.cache_data(show_spinner=False, max_entries=STATE_CACHE_MAX_ENTRIES, ttl=STATE_CACHE_TTL)
+def dpd_describe(state_key, _dpd):
+    """describe() of the filtered DPD column as a one-row frame."""
+    return _dpd.describe().to_frame().transpose()
+
+@st.cache_data(show_spinner=False, max_entries=STATE_CACHE_MAX_ENTRIES, ttl=STATE_CACHE_TTL)
+def overview_kpis(state_key, _frame):
+    """Overview totals as plain floats, plus the row count; reruns with the same filters skip the reduction."""
+    # one fused column-wise reduction instead of a separate pass per KPI (missing columns count as 0)
+    kpi_cols = ['sum_disbursed', 'sum_recovered', 'outstanding']
+    kpis = dict.fromkeys(kpi_cols, 0.0)
+    present = [c for c in kpi_cols if c in _frame.columns]
+    if present:
+        kpis.update(zip(present, np.nansum(_frame[present].to_numpy(dtype=float), axis=0).tolist()))
+    kpis['n'] = len(_frame)
+    return kpis
+
+# One monthly aggregation (cached) shared by the trend, recovery-rate and MoM views
+monthly_cols = tuple(c for c in ('sum_disbursed', 'sum_recovered', 'outstanding', 'sum_setup_fee') if c in filtered.columns)
+
+@st.cache_data(show_spinner=False, max_entries=STATE_CACHE_MAX_ENTRIES, ttl=STATE_CACHE_TTL)
+def cached_figures(state_key, names, _builds):
+    """Build figures once per (file, filters, chart names) and keep their plain-dict form; independent builds run in threads."""
+    if len(_builds) == 1:
+        return [_builds[0]().to_dict()]
+    with ThreadPoolExecutor(max_workers=min(4, len(_builds))) as ex:
+        futures = [ex.submit(build) for build in _builds]
+        return [f.result().to_dict() for f in futures]
+
+# Helper: resolve [(name, build), ...] into {name: go.Figure} through the figure cache
+def build_figures(items):
+    if not items:
+        return {}
+    names = tuple(name for name, _ in items)
+    dicts = cached_figures(state_key, names, [build for _, build in items])
+    return {name: go.Figure(d) for name, d in zip(names, dicts)}
+
+# Helper: render a figure; the stable key lets Streamlit reuse the chart component across reruns
+def show_chart(name, fig):
+    st.plotly_chart(fig, use_container_width=True, key=name)
+
+def show_figure(name, build):
+    show_chart(name, build_figures([(name, build)])[name])
 
 # --- Overview ---
-with tab_overview:
+def render_overview():
     st.subheader("Portfolio Overview")
-    total_disbursed = filtered.get('sum_disbursed', pd.Series(dtype=float)).sum()
-    total_recovered = filtered.get('sum_recovered', pd.Series(dtype=float)).sum()
-    outstanding = filtered.get('outstanding', pd.Series(dtype=float)).sum()
+    kpis = overview_kpis(state_key, filtered)
+    total_disbursed, total_recovered, outstanding = kpis['sum_disbursed'], kpis['sum_recovered'], kpis['outstanding']
     recovery_pct = (total_recovered / total_disbursed * 100) if total_disbursed else 0
 
     c1, c2, c3, c4 = st.columns(4)
@@ -131,136 +469,134 @@ with tab_overview:
     st.dataframe(filtered.head())
 
 # --- Trend Analysis ---
-with tab_trend:
+def render_trend():
     st.subheader("Monthly Loan & Recovery Trends")
     if 'sum_disbursed' in filtered.columns and 'sum_recovered' in filtered.columns:
-        monthly = filtered.groupby('Loan_Month_Year')[['sum_disbursed', 'sum_recovered']].sum().reset_index()
-        monthly = sort_month_df(monthly, 'Loan_Month_Year')
-        fig = px.line(monthly, x='Loan_Month_Year', y=['sum_disbursed', 'sum_recovered'], markers=True,
-                      labels={'value': 'PKR', 'variable': 'Metric'}, title="Monthly Disbursed vs Recovered")
-        st.plotly_chart(fig, use_container_width=True)
+        monthly_all = aggregate_monthly(state_key, df, mask, monthly_cols)
+        show_figure('trend', lambda: multi_line(with_month_labels(monthly_all), 'Loan_Month_Year', ['sum_disbursed', 'sum_recovered'],
+                                                "Monthly Disbursed vs Recovered", y_title='PKR', legend_title='Metric'))
     else:
         st.info("Missing columns for trend analysis ('sum_disbursed' and/or 'sum_recovered'). Detected mapping: " + str(found))
 
 # --- Customer Segmentation ---
-with tab_seg:
+def render_segmentation():
     st.subheader("Customer Segmentation")
+    seg_figs = []
     if 'gender' in filtered.columns:
-        gcounts = filtered['gender'].fillna('Unknown').value_counts().reset_index()
+        gcounts = count_values(filtered['gender']).reset_index()
         gcounts.columns = ['Gender', 'Count']
-        fig = px.pie(gcounts, names='Gender', values='Count', title="Gender distribution")
-        st.plotly_chart(fig, use_container_width=True)
+        seg_figs.append(('gender_pie', lambda: px.pie(gcounts, names='Gender', values='Count', title="Gender distribution")))
+    if 'segment' in filtered.columns:
+        scounts = count_values(filtered['segment']).reset_index()
+        scounts.columns = ['Segment', 'Count']
+        seg_figs.append(('segment_bar', lambda: px.bar(scounts, x='Segment', y='Count', title="Customers by Segment")))
+    figs = build_figures(seg_figs)
+
+    if 'gender_pie' in figs:
+        show_chart('gender_pie', figs['gender_pie'])
     else:
         st.info("Gender column not detected. Detected mapping: " + str(found))
 
-    if 'segment' in filtered.columns:
-        scounts = filtered['segment'].fillna('Unknown').value_counts().reset_index()
-        scounts.columns = ['Segment', 'Count']
-        fig2 = px.bar(scounts, x='Segment', y='Count', title="Customers by Segment")
-        st.plotly_chart(fig2, use_container_width=True)
+    if 'segment_bar' in figs:
+        show_chart('segment_bar', figs['segment_bar'])
 
 # --- Risk Analysis ---
-with tab_risk:
+def render_risk():
     st.subheader("Risk Analysis & DPD distribution")
     if 'days_past_due' in filtered.columns:
-        filtered['days_past_due'] = pd.to_numeric(filtered['days_past_due'], errors='coerce')
+        dpd = filtered['days_past_due']
+        figs = build_figures([
+            ('dpd_hist_all', lambda: binned_histogram(dpd, 40, "DPD Distribution (all)")),
+            ('dpd_hist_overdue', lambda: binned_histogram(dpd[dpd > 0], 40, "Overdue DPD Distribution (days > 0)")),
+        ])
         st.markdown("Overall DPD histogram (including negative values = not yet due)")
-        fig_all = px.histogram(filtered, x='days_past_due', nbins=40, title="DPD Distribution (all)")
-        st.plotly_chart(fig_all, use_container_width=True)
+        show_chart('dpd_hist_all', figs['dpd_hist_all'])
 
         st.markdown("DPD histogram (only overdue loans: days_past_due > 0)")
-        overdue = filtered[filtered['days_past_due'] > 0].copy()
-        fig_overdue = px.histogram(overdue, x='days_past_due', nbins=40, title="Overdue DPD Distribution (days > 0)")
-        st.plotly_chart(fig_overdue, use_container_width=True)
+        show_chart('dpd_hist_overdue', figs['dpd_hist_overdue'])
 
         st.markdown("DPD summary statistics")
-        stats = filtered['days_past_due'].describe().to_frame().transpose()
+        stats = dpd_describe(state_key, filtered['days_past_due'])
         st.dataframe(stats)
     else:
         st.info("No DPD column detected. Detected mapping: " + str(found))
 
 # --- Repayment Rate (MoM) ---
-with tab_recovery:
+def render_recovery():
     st.subheader("Month-to-Month Recovery Rate")
     if {'sum_recovered', 'sum_disbursed'}.issubset(filtered.columns):
-        mr = filtered.groupby('Loan_Month_Year')[['sum_recovered', 'sum_disbursed']].sum().reset_index()
-        mr = sort_month_df(mr, 'Loan_Month_Year')
-        mr['recovery_pct'] = (mr['sum_recovered'] / mr['sum_disbursed'] * 100).replace([float('inf'), -float('inf')], 0)
-        fig_r = px.line(mr, x='Loan_Month_Year', y='recovery_pct', markers=True, title="Monthly Recovery Rate (%)")
-        st.plotly_chart(fig_r, use_container_width=True)
+        mr = aggregate_monthly(state_key, df, mask, monthly_cols)
+        show_figure('recovery_rate', lambda: px.line(with_month_labels(mr), x='Loan_Month_Year', y='recovery_pct', markers=True, title="Monthly Recovery Rate (%)"))
     else:
         st.info("Missing sum_recovered and/or sum_disbursed for recovery rate calculation. Detected mapping: " + str(found))
 
+# DPD buckets as right-closed intervals: (-inf, 0], (0, 30], (30, 60], (60, 90], (90, inf)
+DPD_BUCKET_EDGES = [-np.inf, 0, 30, 60, 90, np.inf]
+DPD_BUCKET_LABELS = ['Current/Not due', '1-30', '31-60', '61-90', '90+']
+
 # --- DPD by Segment (improved visuals) ---
-with tab_dpdseg:
+def render_dpd_by_segment():
     st.subheader("DPD by Segment (violin + buckets)")
     if {'segment', 'days_past_due'}.issubset(filtered.columns):
-        filtered['days_past_due'] = pd.to_numeric(filtered['days_past_due'], errors='coerce')
-
-        # create buckets for discrete coloring (works on older plotly versions)
-        def dpd_bucket(x):
-            try:
-                x = float(x)
-            except:
-                return 'Unknown'
-            if x <= 0:
-                return 'Current/Not due'
-            if x <= 30:
-                return '1-30'
-            if x <= 60:
-                return '31-60'
-            if x <= 90:
-                return '61-90'
-            return '90+'
-
-        filtered['dpd_bucket'] = filtered['days_past_due'].apply(dpd_bucket)
+        # only these two columns are plotted; filtered itself is never modified here
+        seg_dpd = filtered[['segment', 'days_past_due']]
+
+        # Strip plot colored by bucket (discrete colors), capped per segment to keep the payload small.
+        # Sampling and bucketing happen inside the build, so they are skipped when the figure is cached.
+        def build_strip():
+            strip_points = sample_per_group(seg_dpd, 'segment', 2000)
+            # create buckets for discrete coloring (works on older plotly versions); missing DPD goes to 'Unknown'
+            buckets = pd.cut(strip_points['days_past_due'], bins=DPD_BUCKET_EDGES, labels=DPD_BUCKET_LABELS)
+            strip_points = strip_points.assign(dpd_bucket=buckets.cat.add_categories(['Unknown']).fillna('Unknown'))
+            return webgl_strip(strip_points, 'segment', 'days_past_due', 'dpd_bucket',
+                               "All DPD points by Segment (colored by bucket)")
 
         # Violin (shows distribution per segment, focuses on density)
-        overdue = filtered[filtered['days_past_due'] > 0]
-        if overdue.empty:
+        has_overdue = bool((seg_dpd['days_past_due'] > 0).any())
+        dpdseg_figs = [('dpd_strip', build_strip)]
+        if has_overdue:
+            dpdseg_figs.insert(0, ('dpd_violin', lambda: px.violin(seg_dpd[seg_dpd['days_past_due'] > 0], x='segment', y='days_past_due',
+                                                                   box=True, points='outliers',
+                                                                   title="Overdue DPD distribution by Segment (violin + outliers)")))
+        figs = build_figures(dpdseg_figs)
+
+        if not has_overdue:
             st.info("No overdue loans (days_past_due > 0) to show violin for.")
         else:
-            violin = px.violin(overdue, x='segment', y='days_past_due', box=True, points='all',
-                               title="Overdue DPD distribution by Segment (violin + points)")
-            st.plotly_chart(violin, use_container_width=True)
-
-        # Strip plot colored by bucket (discrete colors)
-        strip = px.strip(filtered, x='segment', y='days_past_due', color='dpd_bucket',
-                         title="All DPD points by Segment (colored by bucket)")
-        strip.update_traces(jitter=0.3, marker=dict(size=6, opacity=0.7))
-        st.plotly_chart(strip, use_container_width=True)
+            show_chart('dpd_violin', figs['dpd_violin'])
+        show_chart('dpd_strip', figs['dpd_strip'])
 
         # Aggregated segment stats
-        seg_stats = filtered.groupby('segment')['days_past_due'].agg(['count', 'mean', 'median', 'max']).reset_index()
-        seg_stats.columns = ['Segment', 'Count', 'Mean_DPD', 'Median_DPD', 'Max_DPD']
-        # percent overdue
-        pct_overdue = filtered.groupby('segment').apply(lambda x: (x['days_past_due'] > 0).sum() / max(1, len(x)) * 100).reset_index(name='Pct_Overdue')
-        seg_stats = seg_stats.merge(pct_overdue, left_on='Segment', right_on='segment').drop(columns=['segment'])
-        seg_stats['Pct_Overdue'] = seg_stats['Pct_Overdue'].round(2)
+        seg_stats = segment_dpd_stats(state_key, seg_dpd)
         st.subheader("DPD summary by Segment")
         st.dataframe(seg_stats)
     else:
         st.info("Segment and/or DPD columns not detected. Detected mapping: " + str(found))
 
 # --- MoM % Change (Sum_Set_up_Fee as line) ---
-with tab_mom:
+def render_mom():
     st.subheader("Month-to-Month % Change (select metric)")
-    available_metrics = []
-    if 'sum_setup_fee' in filtered.columns:
-        available_metrics.append('sum_setup_fee')
-    if 'sum_recovered' in filtered.columns:
-        available_metrics.append('sum_recovered')
-    if 'sum_disbursed' in filtered.columns:
-        available_metrics.append('sum_disbursed')
+    available_metrics = [c for c in MOM_METRICS if c in filtered.columns]
 
     if not available_metrics:
         st.info("No candidate metrics found for MoM % change. Detected mapping: " + str(found))
     else:
         metric = st.selectbox("Choose metric for MoM % change (line chart preferred for setup fee)", options=available_metrics, index=0)
-        mom = filtered.groupby('Loan_Month_Year')[[metric]].sum().reset_index()
-        mom = sort_month_df(mom, 'Loan_Month_Year')
-        mom[metric + '_mom_pct'] = mom[metric].pct_change() * 100
+        mom = aggregate_monthly(state_key, df, mask, monthly_cols)
         # plot line for setup fee, bar otherwise (but user can choose)
-        fig_mom = px.line(mom, x='Loan_Month_Year', y=metric + '_mom_pct', markers=True, title=f"MoM % Change: {metric}")
-        st.plotly_chart(fig_mom, use_container_width=True)
-
+        show_figure(f'mom_{metric}', lambda: px.line(with_month_labels(mom), x='Loan_Month_Year', y=metric + '_mom_pct', markers=True, title=f"MoM % Change: {metric}"))
+
+# --- Views ---
+# Registry of view label -> render function. st.tabs would execute every tab body on each rerun;
+# with a radio only the selected view computes and draws anything.
+VIEWS = {
+    "Overview": render_overview,
+    "Trend Analysis": render_trend,
+    "Customer Segmentation": render_segmentation,
+    "Risk Analysis": render_risk,
+    "Repayment Rate (MoM)": render_recovery,
+    "DPD by Segment": render_dpd_by_segment,
+    "MoM % Change": render_mom,
+}
+view = st.radio("View", list(VIEWS), horizontal=True, key="active_view", label_visibility="collapsed")
+VIEWS[view]()